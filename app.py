@@ -1,42 +1,273 @@
 import streamlit as st
 from google import genai
 from google.genai import types
+from google.genai import errors as genai_errors
 from PIL import Image, ImageOps
 import io
 import os
+import zlib
+import http.client
 from dotenv import load_dotenv
-import base64
 import time
 import json
+import hashlib
+import threading
+from collections import OrderedDict
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait
 import boto3
+from boto3.s3.transfer import TransferConfig
+import botocore.httpsession
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
 
 # 環境変数の読み込み
 load_dotenv()
 
+# HTTP書き込みバッファの拡張
+HTTP_WRITE_BUFFER_SIZE = 1024 * 1024
+
+def _set_default_blocksize(init, size):
+    """http.client.HTTPConnection.__init__ の blocksize 引数のデフォルト値を書き換える"""
+    arg_names = init.__code__.co_varnames[:init.__code__.co_argcount]
+    defaults = list(init.__defaults__)
+    defaults[arg_names.index('blocksize') - (len(arg_names) - len(defaults))] = size
+    init.__defaults__ = tuple(defaults)
+
+# MB単位の画像送信でsend呼び出しが細切れにならないよう、S3への書き込み単位を1MiBに拡張
+if botocore.httpsession.BUFFER_SIZE:
+    # urllib3 2.x: botocore が接続プール経由で blocksize（128KiB）を明示的に渡すため、その値を書き換える
+    botocore.httpsession.BUFFER_SIZE = HTTP_WRITE_BUFFER_SIZE
+else:
+    # urllib3 1.x: 接続は http.client のデフォルト（8KiB）をそのまま使う
+    _set_default_blocksize(http.client.HTTPConnection.__init__, HTTP_WRITE_BUFFER_SIZE)
+
 # Gemini API設定
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+# 画像生成は30秒〜2分程度かかるため、タイムアウトは長めに設定（ミリ秒）
+GEMINI_TIMEOUT_MS = 180_000
+# 全セッション合計でのGemini同時呼び出し数の上限（レート制限対策）
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "5"))
+
+@st.cache_resource(show_spinner=False)
+def get_genai_client(api_key):
+    """Gemini APIクライアントを取得（再実行・セッション間で共有し、HTTP接続を使い回す）"""
+    return genai.Client(
+        api_key=api_key,
+        http_options=types.HttpOptions(timeout=GEMINI_TIMEOUT_MS)
+    )
+
 if GOOGLE_API_KEY:
-    client = genai.Client(api_key=GOOGLE_API_KEY)
+    client = get_genai_client(GOOGLE_API_KEY)
 else:
     client = None
 
+# 画像解析（Step 1）のモデルと思考レベル（デプロイごとに環境変数で調整可能）
+VISION_MODEL = os.getenv("GEMINI_VISION_MODEL", "gemini-3-flash-preview")
+VISION_THINK = os.getenv("GEMINI_THINK", "medium")
+VISION_THINK_LEVELS = ["low", "medium", "high"]
+
 # AWS S3設定
 AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
 AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
 S3_REGION = os.getenv("S3_REGION")
 
+# CloudFront設定（任意：設定時は画像をCDN経由で配信）
+CLOUDFRONT_DOMAIN = os.getenv("CLOUDFRONT_DOMAIN")
+
+# 履歴一覧のインデックス（バケット直下に履歴フォルダ名の一覧を保持）
+HISTORY_INDEX_KEY = "index.json"
+HISTORY_INDEX_MAX_RETRIES = 5
+# 条件付きGET用に保持するメタデータ（ETagと本文）の最大件数（超えたら古いものから破棄）
+METADATA_ETAG_STORE_MAX_ENTRIES = 2000
+
+# 画像解析結果のキャッシュ（履歴フォルダと区別するため専用のフォルダに保存）
+CACHE_FOLDER = "cache"
+ANALYSIS_CACHE_PREFIX = f"{CACHE_FOLDER}/vision"
+
+# 履歴画像の設定
+THUMBNAIL_SIZE = (400, 400)
+THUMBNAIL_JPEG_QUALITY = 85
+
+# 再エンコードせずに元画像として保存する形式（PILの判定形式 → 拡張子とContent-Type）
+ORIGINAL_PASSTHROUGH_FORMATS = {
+    "JPEG": (".jpg", "image/jpeg"),
+    # iPhone等のMPO（深度マップ等を含むJPEG）は先頭の画像だけを通常のJPEGとして保存
+    "MPO": (".jpg", "image/jpeg"),
+    "PNG": (".png", "image/png"),
+}
+# 元画像のExif情報のうち保存時に残すタグ（位置情報などは削除し、表示の向きだけを維持）
+EXIF_ORIENTATION_TAG = 0x0112
+PRESIGNED_URL_EXPIRES = 3600
+# 履歴画像はタイムスタンプ付きのキーで上書きされないため、長期キャッシュを許可
+# （共有キャッシュへの保存を明示的に許可する public は付けない）
+IMAGE_CACHE_CONTROL = 'max-age=31536000, immutable'
+
+# 旧形式の履歴（metadata.json に files がない）で使われていたファイル名
+LEGACY_HISTORY_FILES = {
+    "original": "original.png",
+    "original_thumbnail": "original_thumbnail.png",
+    "generated": "generated.png",
+    "thumbnail": "thumbnail.png",
+}
 
-# S3クライアント初期化
-if AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY:
-    s3_client = boto3.client(
+
+# 撮影スタイル設定（プロンプト用。再実行のたびに作り直さないようモジュールレベルで定義）
+# 背景設定
+BACKGROUND_MAP = {
+    "白背景": "clean white background",
+    "黒背景": "matte black background",
+    "木目テーブル": "natural wood grain table surface",
+    "大理石": "elegant marble table surface",
+    "和紙": "traditional Japanese washi paper background"
+}
+
+# 撮影角度設定（y軸方向：カメラの高さ/俯瞰度）
+ANGLE_MAP = {
+    "斜め45度": "The camera is positioned at a moderate height above the table, looking down at the bento box at approximately 30-40 degrees from horizontal. This angle shows both the top surface of the food AND the front vertical side wall of the container clearly, creating depth while maintaining visibility of contents.",
+    "真上俯瞰": "The camera is positioned DIRECTLY overhead at 90 degrees, perfectly perpendicular to the table surface. Pure bird's eye view looking STRAIGHT DOWN. NO angle whatsoever - completely flat, top-down perspective."
+}
+
+# 弁当の向き設定（テーブル上での物理的な配置）
+ROTATION_MAP = {
+    "正面配置": {
+        "rule": "**[Crucial: Orientation & Alignment]**\n* The bento box is NOT rotated diagonally on the table surface.\n* The edges of the box are perfectly parallel to the frame edges (top edge parallel to top of frame, sides parallel to sides of frame).\n* NO rotation whatsoever. The box maintains a straight, unrotated position.",
+        "description": "The box faces the camera squarely."
+    },
+    "斜め配置": {
+        "rule": "**[Crucial: Orientation & Alignment]**\n* The bento box IS rotated diagonally on the table surface.\n* The box is tilted approximately 45 degrees CLOCKWISE (from viewer's perspective).\n* One corner of the box points towards the top of the frame, creating a diamond-like orientation.",
+        "description": "Creates dynamic diagonal depth."
+    }
+}
+
+# 照明設定
+LIGHTING_MAP = {
+    "明るいスタジオ": "Bright, even studio lighting (high-key). Soft shadows. The food looks fresh, glossy, vibrant, and appetizing.",
+    "柔らか自然光": "Soft, natural window light. Gentle shadows. The food looks fresh, natural, and inviting.",
+    "ドラマチック": "Dramatic side lighting with strong shadows. The food looks bold, artistic, and textured."
+}
+
+# 余白設定（構図の概念で指定し、縁が見切れないことを保証）
+MARGIN_MAP = {
+    "標準": "With some negative space around the bento box. A little breathing room on the table surface. Not cropped tightly. Centered composition. The entire bento box must fit completely within the frame with NO edges cut off.",
+    "広い": "Ample negative space. Vast empty table surface surrounding the bento box. Minimalist composition with lots of empty space. Long shot. The bento box is small in the center of the large frame. The entire bento box must fit completely within the frame with NO edges cut off."
+}
+
+# アスペクト比設定（プロンプト用）
+ASPECT_RATIO_PROMPT_MAP = {
+    "正方形(1:1)": "**[Output Format]**\nGenerate the output image in SQUARE format with 1:1 aspect ratio (width equals height).",
+    "縦長(3:4)": "**[Output Format]**\nGenerate the output image in PORTRAIT/VERTICAL format with 3:4 aspect ratio (width:height = 3:4, taller than wide).",
+    "横長(4:3)": "**[Output Format]**\nGenerate the output image in LANDSCAPE/HORIZONTAL format with 4:3 aspect ratio (width:height = 4:3, wider than tall)."
+}
+
+# 容器の汚れ補正の選択肢（補正する場合の表示名は判定にも使うため定数で共有）
+CONTAINER_CLEAN_OPTION = "容器汚れを補正"
+# 容器清掃指示（「容器汚れを補正」選択時のみプロンプトに追加）
+CONTAINER_CLEAN_INSTRUCTION = """
+CONTAINER CLEANING:
+- Clean any sauce stains, oil marks, or liquid spills on the bento box container surfaces (walls, edges, exterior)
+- The container should look pristine and clean
+- CRITICAL: Do NOT alter, change, or modify the food contents inside the compartments
+- Only clean the container itself, not the food
+"""
+
+# Step 1: 画像解析プロンプト（容器・配置・食材を明確に指示し、メタデータも同時に生成）
+VISION_PROMPT = """
+Analyze this bento image for a commercial photography prompt.
+Extract the following visual details accurately:
+
+1. CONTAINER: Describe the material, shape, color, and pattern of the bento box (e.g., wood-grain paper box, black plastic, round, rectangular).
+2. LAYOUT: Describe specifically where each food item is placed (e.g., Grilled salmon on the center-left, Tamagoyaki on the top-right).
+3. FOOD: List all food items with visual details (texture, color).
+
+IMPORTANT: Do NOT describe the camera angle, shooting angle, or perspective (e.g., high-angle, overhead, low-angle).
+Only describe the container, food arrangement, and food details.
+
+Return JSON with the following fields:
+- analyzed_content: The visual details above as a descriptive paragraph for image generation. Answer in English.
+- title: A short Japanese title (max 20 characters, e.g., "ハンバーグ弁当", "幕の内弁当")
+- description: A brief Japanese description (max 50 characters)
+- tags: An array of 3-5 Japanese search tags (e.g., ["ハンバーグ", "和食", "唐揚げ"])
+"""
+
+# Step 1: JSONの出力形式（マークダウン除去などの後処理を不要にする）
+VISION_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "analyzed_content": {"type": "string"},
+        "title": {"type": "string"},
+        "description": {"type": "string"},
+        "tags": {"type": "array", "items": {"type": "string"}}
+    },
+    "required": ["analyzed_content", "title", "description", "tags"]
+}
+
+# 高速モード（Step 1の解析を省略）で内容説明の代わりに使う指示
+FAST_MODE_CONTENT_INSTRUCTION = "First carefully examine the container and every food item in the input image (material, shape, color, placement, texture), then reproduce them exactly while applying the style rules above."
+
+# CSS: フォントサイズ縮小（ページに毎回描画する必要があるため、文字列のみ定数化）
+CUSTOM_CSS = """
+<style>
+[data-testid="stMetricValue"] {
+    font-size: 1.2rem;
+}
+[data-testid="stMetricLabel"] {
+    font-size: 0.85rem;
+}
+h3 {
+    font-size: 1.1rem;
+    margin-top: 1rem;
+    margin-bottom: 0.5rem;
+}
+/* アンカーリンクアイコンを非表示 */
+h1 a, h2 a, h3 a, h4 a {
+    display: none !important;
+}
+.css-15zrgzn {
+    display: none !important;
+}
+</style>
+"""
+
+# バックグラウンド処理（S3の並列取得・アップロード）のスレッド数
+BACKGROUND_MAX_WORKERS = 16
+
+# S3クライアント設定
+S3_CLIENT_CONFIG = Config(
+    # 並列取得時に接続プールが詰まらないよう上限を拡張（デフォルトは10）
+    max_pool_connections=32,
+    # TCP keep-aliveでアイドル後の再接続（TLSハンドシェイク）を抑制
+    tcp_keepalive=True,
+    # 一時的なエラーやスロットリングはクライアント側で再試行
+    retries={'max_attempts': 3, 'mode': 'adaptive'},
+    connect_timeout=3,
+    read_timeout=10
+)
+
+# 大きな画像の転送設定（5MBを超える場合はマルチパートで並列転送）
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=5 * 1024 * 1024,
+    multipart_chunksize=5 * 1024 * 1024,
+    max_concurrency=8,
+    use_threads=True
+)
+
+# S3クライアント初期化（再実行・セッション間で使い回し、認証情報が変われば作り直す）
+@st.cache_resource(show_spinner=False)
+def get_s3_client(access_key_id, secret_access_key, region):
+    return boto3.client(
         's3',
-        aws_access_key_id=AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-        region_name=S3_REGION
+        aws_access_key_id=access_key_id,
+        aws_secret_access_key=secret_access_key,
+        region_name=region,
+        config=S3_CLIENT_CONFIG
     )
+
+if AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY:
+    s3_client = get_s3_client(AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, S3_REGION)
 else:
     s3_client = None
 
@@ -46,134 +277,531 @@ st.set_page_config(
     layout="wide"
 )
 
+# 並列実行ヘルパー
+@st.cache_resource(show_spinner=False)
+def _get_background_executor():
+    """バックグラウンド処理用のスレッドプール（全セッションで共有し、再実行のたびに作り直さない）"""
+    return ThreadPoolExecutor(max_workers=BACKGROUND_MAX_WORKERS)
+
+def submit_in_thread(func, *args):
+    """関数をバックグラウンドのスレッドで実行開始し、Futureを返す（Streamlitのコンテキストを引き継ぐ）"""
+    ctx = get_script_run_ctx()
+
+    def run():
+        add_script_run_ctx(ctx=ctx)
+        return func(*args)
+
+    return _get_background_executor().submit(run)
+
+def map_in_threads(func, items):
+    """I/O待ちの処理をスレッドで並列実行し、結果を入力順のリストで返す"""
+    futures = [submit_in_thread(func, item) for item in items]
+    return [future.result() for future in futures]
+
 # S3ヘルパー関数
-def save_image_to_s3(image, key):
-    """画像をS3にアップロード"""
+def save_image_to_s3(image, key, quality=90):
+    """画像をS3にアップロード（拡張子 .jpg はJPEG、それ以外はPNGで保存）"""
     if not s3_client:
         return False
     try:
         img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, format='PNG')
+        if key.endswith('.jpg'):
+            # JPEGはアルファチャンネル非対応のためRGBに変換
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            image.save(img_byte_arr, format='JPEG', quality=quality, optimize=True, progressive=True)
+            content_type = 'image/jpeg'
+        else:
+            image.save(img_byte_arr, format='PNG')
+            content_type = 'image/png'
+        # マルチパートの閾値未満なら TransferManager を介さず1回のPUTで送る
+        if img_byte_arr.tell() < S3_TRANSFER_CONFIG.multipart_threshold:
+            return save_bytes_to_s3(img_byte_arr.getvalue(), key, content_type)
         img_byte_arr.seek(0)
         s3_client.upload_fileobj(
             img_byte_arr,
             S3_BUCKET_NAME,
             key,
-            ExtraArgs={'ContentType': 'image/png'}
+            ExtraArgs={'ContentType': content_type, 'CacheControl': IMAGE_CACHE_CONTROL},
+            Config=S3_TRANSFER_CONFIG
         )
         return True
     except ClientError as e:
         st.error(f"S3アップロードエラー: {str(e)}")
         return False
 
+def downscale_image(image, max_size):
+    """長辺が max_size 以下になるよう縮小した新しい画像を返す（フル解像度のコピーは作らない）"""
+    scale = min(max_size[0] / image.width, max_size[1] / image.height)
+    if scale >= 1:
+        return image.copy()
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    return image.resize(size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+
+def _exif_segment(data):
+    """元画像の向き情報だけを持つExifデータを作成（向き情報がなければ None）"""
+    orientation = Image.open(io.BytesIO(data)).getexif().get(EXIF_ORIENTATION_TAG)
+    if not orientation or orientation == 1:
+        return None
+    exif = Image.Exif()
+    exif[EXIF_ORIENTATION_TAG] = orientation
+    return exif.tobytes()
+
+def _strip_jpeg_metadata(data):
+    """JPEGを再エンコードせずに、Exif/XMP/MPOの付属画像を取り除く（向き情報のみ残す）"""
+    segments = [data[:2]]
+    exif = _exif_segment(data)
+    if exif:
+        segments.append(b'\xff\xe1' + (len(exif) + 2).to_bytes(2, 'big') + exif)
+    pos = 2
+    while True:
+        # マーカー前の埋め草(0xFF)を読み飛ばす
+        while data[pos + 1] == 0xFF:
+            pos += 1
+        marker = data[pos + 1]
+        if marker == 0xD9:  # EOI: MPOの2枚目以降の画像はこの後ろにあるため含めない
+            segments.append(data[pos:pos + 2])
+            return b''.join(segments)
+        length = int.from_bytes(data[pos + 2:pos + 4], 'big')
+        end = pos + 2 + length
+        # APP1(Exif/XMP) と APP2 のMPFインデックスは位置情報や付属画像を指すため破棄
+        if not (marker == 0xE1 or (marker == 0xE2 and data[pos + 4:pos + 8] == b'MPF\x00')):
+            segments.append(data[pos:end])
+        pos = end
+        if marker == 0xDA:
+            # 圧縮データ内の0xFFは 0xFF00 か RSTn(0xFFD0-D7) のみなので、それ以外が次のマーカー
+            while True:
+                pos = data.index(b'\xff', pos)
+                if data[pos + 1] != 0 and not 0xD0 <= data[pos + 1] <= 0xD7:
+                    break
+                pos += 2
+            segments.append(data[end:pos])
+
+def _strip_png_metadata(data):
+    """PNGを再エンコードせずに、eXIf/テキストチャンクを取り除く（向き情報のみ残す）"""
+    chunks = [data[:8]]
+    exif = _exif_segment(data)
+    pos = 8
+    while pos < len(data):
+        length = int.from_bytes(data[pos:pos + 4], 'big')
+        chunk_type = data[pos + 4:pos + 8]
+        end = pos + 12 + length
+        if chunk_type == b'IDAT' and exif:
+            # eXIf は IDAT より前に置く必要がある（先頭の "Exif\0\0" はPNGでは不要）
+            body = b'eXIf' + exif[6:]
+            chunks.append(len(exif[6:]).to_bytes(4, 'big') + body + zlib.crc32(body).to_bytes(4, 'big'))
+            exif = None
+        if chunk_type not in (b'eXIf', b'tEXt', b'zTXt', b'iTXt'):
+            chunks.append(data[pos:end])
+        pos = end
+    return b''.join(chunks)
+
+def strip_image_metadata(data, image_format):
+    """アップロードされた画像から位置情報などのメタデータを取り除く（画質は変わらない。解析できなければ None）"""
+    try:
+        if image_format == 'PNG':
+            return _strip_png_metadata(data)
+        return _strip_jpeg_metadata(data)
+    except (IndexError, ValueError, OSError):
+        return None
+
+def save_bytes_to_s3(data, key, content_type):
+    """エンコード済みの画像データを再エンコードせずにS3にアップロード"""
+    if not s3_client:
+        return False
+    try:
+        s3_client.put_object(
+            Bucket=S3_BUCKET_NAME,
+            Key=key,
+            Body=data,
+            ContentLength=len(data),
+            ContentType=content_type,
+            CacheControl=IMAGE_CACHE_CONTROL
+        )
+        return True
+    except ClientError as e:
+        st.error(f"S3アップロードエラー: {str(e)}")
+        return False
+
+def save_original_image_to_s3(data, key):
+    """アップロードされた画像をフル解像度でデコードし直し、向きを補正してS3にアップロード"""
+    try:
+        image = Image.open(io.BytesIO(data))
+        ImageOps.exif_transpose(image, in_place=True)
+    except (OSError, ValueError) as e:
+        st.error(f"元画像の読み込みエラー: {str(e)}")
+        return False
+    return save_image_to_s3(image, key)
+
+def save_thumbnail_to_s3(image, key):
+    """サムネイル（長辺400px）を生成してS3にアップロード（大きな画像は reduce で粗く縮小してから仕上げる）"""
+    return save_image_to_s3(downscale_image(image, THUMBNAIL_SIZE), key, quality=THUMBNAIL_JPEG_QUALITY)
+
 def save_metadata_to_s3(metadata, key):
     """メタデータ(JSON)をS3にアップロード"""
     if not s3_client:
         return False
     try:
         metadata_json = json.dumps(metadata, ensure_ascii=False, indent=2)
-        s3_client.put_object(
+        body = metadata_json.encode('utf-8')
+        response = s3_client.put_object(
             Bucket=S3_BUCKET_NAME,
             Key=key,
-            Body=metadata_json.encode('utf-8'),
+            Body=body,
+            ContentLength=len(body),
             ContentType='application/json'
         )
+        # 書き込んだ内容とETagを保持し、次回の取得を条件付きGETにする
+        _set_metadata_etag(key, response['ETag'], json.loads(metadata_json))
+        bust_cache()
         return True
     except ClientError as e:
         st.error(f"S3アップロードエラー: {str(e)}")
         return False
 
-@st.cache_data(ttl=3600)
-def get_image_from_s3(key):
-    """S3から画像を取得（キャッシュ付き）"""
-    if not s3_client:
-        return None
+@st.cache_resource(show_spinner=False)
+def _metadata_etag_store():
+    """メタデータのETagと本文の保管場所（全セッションで共有。ロックと最近使った順の辞書）"""
+    return threading.Lock(), OrderedDict()
+
+def _get_metadata_etag(key):
+    """保持しているメタデータの (ETag, 本文) を取得（なければ None）"""
+    lock, entries = _metadata_etag_store()
+    with lock:
+        entry = entries.get(key)
+        if entry:
+            entries.move_to_end(key)
+        return entry
+
+def _set_metadata_etag(key, etag, metadata):
+    """メタデータの (ETag, 本文) を保持（上限を超えたら最も使われていないものを破棄）"""
+    lock, entries = _metadata_etag_store()
+    with lock:
+        entries[key] = (etag, metadata)
+        entries.move_to_end(key)
+        while len(entries) > METADATA_ETAG_STORE_MAX_ENTRIES:
+            entries.popitem(last=False)
+
+def _forget_metadata_etag(key):
+    """保持しているメタデータを破棄"""
+    lock, entries = _metadata_etag_store()
+    with lock:
+        entries.pop(key, None)
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _get_metadata_cached(key):
+    """S3からメタデータ(JSON)を取得（キャッシュ本体。ETagによる条件付きGETで未変更時は本文を転送しない）"""
+    previous = _get_metadata_etag(key)
     try:
-        response = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=key)
-        return Image.open(io.BytesIO(response['Body'].read()))
+        if previous:
+            response = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=key, IfNoneMatch=previous[0])
+        else:
+            response = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=key)
     except ClientError as e:
-        # サムネイルが存在しない場合など、静かに None を返す
-        return None
+        # 前回取得時から変更がなければ本文なしの304が返る
+        if previous and e.response['Error']['Code'] in ('304', 'NotModified'):
+            return previous[1]
+        raise
+    metadata = json.loads(response['Body'].read().decode('utf-8'))
+    _set_metadata_etag(key, response['ETag'], metadata)
+    return metadata
 
-@st.cache_data(ttl=3600)
 def get_metadata_from_s3(key):
     """S3からメタデータ(JSON)を取得（キャッシュ付き）"""
     if not s3_client:
         return None
     try:
-        response = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=key)
-        return json.loads(response['Body'].read().decode('utf-8'))
+        return _get_metadata_cached(key)
     except ClientError as e:
         st.error(f"S3ダウンロードエラー: {str(e)}")
         return None
 
+def _scan_history_folders():
+    """S3のフォルダ一覧を走査して履歴一覧を取得（インデックス未作成時のフォールバック）"""
+    # 1回のリクエストでは最大1000件までしか返らないためページを辿る
+    paginator = s3_client.get_paginator('list_objects_v2')
+    folders = []
+    for page in paginator.paginate(
+        Bucket=S3_BUCKET_NAME,
+        Delimiter='/',
+        PaginationConfig={'PageSize': 1000}
+    ):
+        folders.extend(prefix['Prefix'].rstrip('/') for prefix in page.get('CommonPrefixes', []))
+    # 解析キャッシュ用のフォルダは履歴ではないため除外
+    folders = [folder for folder in folders if folder != CACHE_FOLDER]
+    return sorted(folders, reverse=True)
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _list_history_cached():
+    """S3から履歴フォルダ一覧を取得（キャッシュ本体）"""
+    try:
+        response = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=HISTORY_INDEX_KEY)
+        return json.loads(response['Body'].read().decode('utf-8'))
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchKey':
+            raise
+    # インデックスが未作成の場合はフォルダ一覧を走査
+    return _scan_history_folders()
+
 def list_history_from_s3():
-    """S3から履歴一覧を取得"""
+    """S3から履歴一覧を取得（キャッシュ付き）"""
     if not s3_client:
         return []
     try:
-        response = s3_client.list_objects_v2(Bucket=S3_BUCKET_NAME, Delimiter='/')
-        if 'CommonPrefixes' not in response:
-            return []
-        folders = [prefix['Prefix'].rstrip('/') for prefix in response['CommonPrefixes']]
-        return sorted(folders, reverse=True)
+        return _list_history_cached()
     except ClientError as e:
         st.error(f"S3リストエラー: {str(e)}")
         return []
 
+def bust_cache():
+    """履歴一覧とメタデータのキャッシュを破棄（作成・更新・削除後に呼ぶ）"""
+    _list_history_cached.clear()
+    _get_metadata_cached.clear()
+
+def update_history_index(add=None, remove=None):
+    """履歴インデックスを更新（ETagによる条件付き書き込みで同時更新に対応）"""
+    if not s3_client:
+        return False
+    for _ in range(HISTORY_INDEX_MAX_RETRIES):
+        try:
+            try:
+                response = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=HISTORY_INDEX_KEY)
+                folders = set(json.loads(response['Body'].read().decode('utf-8')))
+                condition = {'IfMatch': response['ETag']}
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'NoSuchKey':
+                    raise
+                # 初回はフォルダ一覧を走査してインデックスを作成
+                folders = set(_scan_history_folders())
+                condition = {'IfNoneMatch': '*'}
+
+            if add:
+                folders.add(add)
+            if remove:
+                folders.discard(remove)
+
+            s3_client.put_object(
+                Bucket=S3_BUCKET_NAME,
+                Key=HISTORY_INDEX_KEY,
+                Body=json.dumps(sorted(folders, reverse=True)).encode('utf-8'),
+                ContentType='application/json',
+                **condition
+            )
+            bust_cache()
+            return True
+        except ClientError as e:
+            # 他のセッションが先に更新した場合は読み直して再試行
+            if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                continue
+            st.error(f"S3インデックス更新エラー: {str(e)}")
+            return False
+    st.error("S3インデックス更新エラー: 同時更新が続いたため更新できませんでした")
+    return False
+
+def history_file_key(folder, metadata, name):
+    """履歴内のファイルのS3キーを取得（旧形式の履歴は従来のファイル名を使用）"""
+    filename = metadata.get('files', {}).get(name, LEGACY_HISTORY_FILES[name])
+    return f"{folder}/{filename}"
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _list_folder_files_cached(folder):
+    """履歴フォルダ内のファイル名一覧を取得（キャッシュ本体）"""
+    response = s3_client.list_objects_v2(Bucket=S3_BUCKET_NAME, Prefix=f"{folder}/")
+    return {obj['Key'].split('/', 1)[1] for obj in response.get('Contents', [])}
+
+def history_image_key(folder, metadata, name, fallback_name):
+    """履歴内の画像のS3キーを取得（なければ fallback_name の画像、どちらもなければ None）"""
+    # 新形式の履歴は files に実際に保存したファイル名が記録されている
+    if 'files' in metadata:
+        return history_file_key(folder, metadata, name)
+    # 旧形式の履歴はサムネイルがない場合があるため、フォルダ内のファイルを確認する
+    try:
+        files = _list_folder_files_cached(folder)
+    except ClientError:
+        return history_file_key(folder, metadata, name)
+    for candidate in (name, fallback_name):
+        if LEGACY_HISTORY_FILES[candidate] in files:
+            return history_file_key(folder, metadata, candidate)
+    return None
+
+@st.cache_data(ttl=PRESIGNED_URL_EXPIRES - 600, show_spinner=False)
+def get_presigned_url(key):
+    """S3オブジェクトの署名付きURLを取得（再実行間で同じURLを返しブラウザキャッシュを効かせる）"""
+    if not s3_client:
+        return None
+    return s3_client.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': S3_BUCKET_NAME, 'Key': key},
+        ExpiresIn=PRESIGNED_URL_EXPIRES
+    )
+
+def image_url(key):
+    """画像の表示用URLを取得（CloudFront設定時はCDN経由、未設定時は署名付きURL）"""
+    if not key:
+        return None
+    if CLOUDFRONT_DOMAIN:
+        return f"https://{CLOUDFRONT_DOMAIN}/{key}"
+    return get_presigned_url(key)
+
+# 履歴画像のキーは上書きされないため、一度取得したバイト列は再実行をまたいで使い回す
+@st.cache_data(ttl=600, max_entries=16, show_spinner=False)
+def _get_image_bytes_cached(key):
+    """S3から画像のバイナリデータを取得（キャッシュ本体。大きな画像は s3transfer が範囲指定で並列取得する）"""
+    buffer = io.BytesIO()
+    s3_client.download_fileobj(S3_BUCKET_NAME, key, buffer, Config=S3_TRANSFER_CONFIG)
+    return buffer.getvalue()
+
 def get_image_bytes_from_s3(key):
-    """S3から画像のバイナリデータを取得（ダウンロードボタン用）"""
+    """S3から画像のバイナリデータを取得（ダウンロードボタン用。キャッシュ付き）"""
     if not s3_client:
         return None
     try:
-        response = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=key)
-        return response['Body'].read()
+        return _get_image_bytes_cached(key)
     except ClientError as e:
         st.error(f"S3ダウンロードエラー: {str(e)}")
         return None
 
-def delete_history_from_s3(timestamp):
-    """S3から指定されたタイムスタンプの履歴を削除"""
+def get_analysis_cache(image_hash, prompt_version):
+    """画像解析結果のキャッシュをS3から取得（存在しない場合は None）"""
+    if not s3_client:
+        return None
+    try:
+        response = s3_client.get_object(
+            Bucket=S3_BUCKET_NAME,
+            Key=f"{ANALYSIS_CACHE_PREFIX}/{image_hash}_{prompt_version}.json"
+        )
+        return json.loads(response['Body'].read().decode('utf-8'))
+    except ClientError:
+        return None
+
+def save_analysis_cache(image_hash, prompt_version, result):
+    """画像解析結果のキャッシュをS3に保存（失敗しても加工処理は継続）"""
     if not s3_client:
         return False
     try:
-        # フォルダ内のすべてのオブジェクトを取得
-        response = s3_client.list_objects_v2(
+        s3_client.put_object(
             Bucket=S3_BUCKET_NAME,
-            Prefix=f"{timestamp}/"
+            Key=f"{ANALYSIS_CACHE_PREFIX}/{image_hash}_{prompt_version}.json",
+            Body=json.dumps(result, ensure_ascii=False).encode('utf-8'),
+            ContentType='application/json'
         )
+        return True
+    except ClientError:
+        return False
 
-        if 'Contents' in response:
-            # すべてのオブジェクトを削除
-            for obj in response['Contents']:
-                s3_client.delete_object(Bucket=S3_BUCKET_NAME, Key=obj['Key'])
+def _delete_folder_objects(folder):
+    """S3から指定フォルダ内のオブジェクトをすべて削除（失敗時は ClientError）"""
+    # フォルダ内のすべてのオブジェクトを取得（1000件を超える場合はページを辿る）
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=S3_BUCKET_NAME, Prefix=f"{folder}/"):
+        if 'Contents' in page:
+            # ページ内のオブジェクトを一括削除（1リクエストで最大1000件）
+            response = s3_client.delete_objects(
+                Bucket=S3_BUCKET_NAME,
+                Delete={
+                    'Objects': [{'Key': obj['Key']} for obj in page['Contents']],
+                    'Quiet': True
+                }
+            )
+            # 一括削除は一部のキーだけ失敗しても例外にならないため個別に確認
+            if response.get('Errors'):
+                error = response['Errors'][0]
+                st.error(f"S3削除エラー: {error['Key']} ({error['Code']})")
+                return False
+    return True
 
-        return True
+def delete_history_from_s3(timestamp):
+    """S3から指定されたタイムスタンプの履歴を削除"""
+    if not s3_client:
+        return False
+    try:
+        if not _delete_folder_objects(timestamp):
+            return False
+        _forget_metadata_etag(f"{timestamp}/metadata.json")
+
+        # 画像は削除済みのため、一覧から外せなかった場合もキャッシュは破棄して失敗を返す
+        removed = update_history_index(remove=timestamp)
+        bust_cache()
+        return removed
     except ClientError as e:
         st.error(f"S3削除エラー: {str(e)}")
         return False
 
+def discard_partial_history(timestamp, uploads):
+    """加工に失敗した場合に、先行して保存した元画像を削除"""
+    if not s3_client or not uploads:
+        return
+    # 保存中のアップロードが終わってから削除する
+    wait(uploads)
+    _forget_metadata_etag(f"{timestamp}/metadata.json")
+    try:
+        _delete_folder_objects(timestamp)
+    except ClientError:
+        # 一覧には載らない（インデックス未登録）ため、削除に失敗しても処理は継続
+        pass
+
+# Gemini ヘルパー関数
+def _is_retryable_gemini_error(error):
+    """一時的なエラー（レート制限・サーバーエラー）かどうかを判定"""
+    if isinstance(error, genai_errors.ServerError):
+        return True
+    return isinstance(error, genai_errors.ClientError) and error.code == 429
+
+@st.cache_resource(show_spinner=False)
+def _get_gemini_semaphore(limit):
+    """Gemini呼び出しの同時実行数を制限するセマフォ（全セッションで共有）"""
+    return threading.BoundedSemaphore(limit)
+
+# 一時的なエラーは指数バックオフ（ジッター付き）で再試行し、解析結果を無駄にしない
+# （セマフォは試行ごとに取得するため、バックオフ中の待機は他のリクエストの枠を塞がない）
+gemini_retry = retry(
+    retry=retry_if_exception(_is_retryable_gemini_error),
+    wait=wait_random_exponential(multiplier=1, max=30),
+    stop=stop_after_attempt(4),
+    reraise=True
+)
+
+@gemini_retry
+def analyze_image(image_part, prompt, response_schema, thinking_level=VISION_THINK):
+    """Step 1: 画像を解析して内容説明とメタデータ(JSON)を取得"""
+    with _get_gemini_semaphore(GEMINI_CONCURRENCY):
+        response = client.models.generate_content(
+            model=VISION_MODEL,
+            contents=[prompt, image_part],
+            config=types.GenerateContentConfig(
+                thinking_config=types.ThinkingConfig(thinking_level=thinking_level),
+                response_mime_type="application/json",
+                response_schema=response_schema
+            )
+        )
+    return json.loads(response.text)
+
+@gemini_retry
+def generate_image(prompt, image_part):
+    """Step 3: 元画像を参照しながらプロ写真風の画像を生成"""
+    with _get_gemini_semaphore(GEMINI_CONCURRENCY):
+        return client.models.generate_content(
+            model='gemini-3-pro-image-preview',
+            contents=[prompt, image_part]
+        )
+
 # セッションステート初期化
-if 'processing' not in st.session_state:
-    st.session_state.processing = False
-if 'generation_completed' not in st.session_state:
-    st.session_state.generation_completed = False
-if 'current_uploaded_file' not in st.session_state:
-    st.session_state.current_uploaded_file = None
+SESSION_DEFAULTS = {
+    'processing': False,
+    'generation_completed': False,
+    'current_uploaded_file': None,
+    'list_page': 0,
+    'selected_history': None,
+}
+for state_key, default_value in SESSION_DEFAULTS.items():
+    st.session_state.setdefault(state_key, default_value)
 
 # クエリパラメータから履歴を読み込み
 if 'history' in st.query_params:
     st.session_state.selected_history = st.query_params['history']
-elif 'selected_history' not in st.session_state:
-    st.session_state.selected_history = None
-
-# 履歴フォルダの作成
-HISTORY_DIR = "history"
-if not os.path.exists(HISTORY_DIR):
-    os.makedirs(HISTORY_DIR)
 
 
-# S3から履歴一覧を取得
+# S3から履歴一覧を取得（サイドバーと一覧ページで共用。キャッシュ済みのため再実行時はS3にアクセスしない）
 history_folders = list_history_from_s3()
 
 # サイドバー：AI加工ボタンと履歴
@@ -190,6 +818,20 @@ with st.sidebar:
         st.session_state.selected_history = None
         st.rerun()
 
+    # 解析品質（Step 1の思考レベル。高いほど遅く、トークン消費も増える）
+    vision_think = st.selectbox(
+        "解析品質",
+        VISION_THINK_LEVELS,
+        index=VISION_THINK_LEVELS.index(VISION_THINK) if VISION_THINK in VISION_THINK_LEVELS else 1
+    )
+
+    # 高速モード（解析を省略し、画像生成の1回の呼び出しで完結させる）
+    fast_mode = st.toggle(
+        "高速モード（解析を省略）",
+        value=False,
+        help="解析ステップを省略して加工時間を短縮します。タイトル・タグ・解析内容は保存されません。"
+    )
+
     st.markdown("---")
 
     if history_folders:
@@ -206,28 +848,7 @@ with st.sidebar:
         st.info("まだ履歴がありません")
 
 # CSS: フォントサイズ縮小
-st.markdown("""
-<style>
-[data-testid="stMetricValue"] {
-    font-size: 1.2rem;
-}
-[data-testid="stMetricLabel"] {
-    font-size: 0.85rem;
-}
-h3 {
-    font-size: 1.1rem;
-    margin-top: 1rem;
-    margin-bottom: 0.5rem;
-}
-/* アンカーリンクアイコンを非表示 */
-h1 a, h2 a, h3 a, h4 a {
-    display: none !important;
-}
-.css-15zrgzn {
-    display: none !important;
-}
-</style>
-""", unsafe_allow_html=True)
+st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
 
 # メインエリア
 # クエリパラメータでビューモードを判定
@@ -237,9 +858,6 @@ view_mode = st.query_params.get('view', None)
 if view_mode == 'list':
     st.title("履歴一覧")
 
-    # S3から全履歴を取得
-    history_folders = list_history_from_s3()
-
     # 検索機能
     st.markdown("### 検索・絞り込み")
     search_query = st.text_input("タイトル、タグ、内容で検索", placeholder="例: ハンバーグ")
@@ -248,10 +866,6 @@ if view_mode == 'list':
     items_per_page = 10
     total_pages = (len(history_folders) - 1) // items_per_page + 1 if history_folders else 0
 
-    # セッションステートでページ番号を管理
-    if 'list_page' not in st.session_state:
-        st.session_state.list_page = 0
-
     # ページ番号選択
     if total_pages > 1:
         col_prev, col_page, col_next = st.columns([1, 2, 1])
@@ -273,17 +887,27 @@ if view_mode == 'list':
     end_idx = start_idx + items_per_page
     page_folders = history_folders[start_idx:end_idx]
 
-    # メタデータを取得してフィルタリング
-    filtered_items = []
-    for folder in page_folders:
+    # メタデータとカード用の画像キー（サムネイルがない旧形式の履歴はフルサイズ画像）を並列取得してフィルタリング
+    def load_card(folder):
         metadata = get_metadata_from_s3(f"{folder}/metadata.json")
+        if not metadata:
+            return None, None, None
+        return (
+            metadata,
+            history_image_key(folder, metadata, "original_thumbnail", "original"),
+            history_image_key(folder, metadata, "thumbnail", "generated"),
+        )
+
+    page_cards = map_in_threads(load_card, page_folders)
+    filtered_items = []
+    for folder, (metadata, original_card_key, generated_card_key) in zip(page_folders, page_cards):
         if metadata:
             # 検索クエリでフィルタリング
             if search_query:
                 search_text = f"{metadata.get('title', '')} {' '.join(metadata.get('tags', []))} {metadata.get('description', '')}"
                 if search_query.lower() not in search_text.lower():
                     continue
-            filtered_items.append((folder, metadata))
+            filtered_items.append((folder, metadata, original_card_key, generated_card_key))
 
     # グリッド表示（4列）
     if filtered_items:
@@ -293,51 +917,35 @@ if view_mode == 'list':
             cols = st.columns(cols_per_row)
             for j, col in enumerate(cols):
                 if i + j < len(filtered_items):
-                    folder, metadata = filtered_items[i + j]
+                    folder, metadata, original_card_key, generated_card_key = filtered_items[i + j]
                     with col:
                         # 固定高さのコンテナを作成
                         with st.container():
                             # カード全体のHTMLを構築（固定高さ）
-                            # 変更前と変更後のサムネイル画像を取得（高速化のため）
-                            original_img = get_image_from_s3(f"{folder}/original_thumbnail.png")
-                            if not original_img:
-                                # サムネイルがない場合はフルサイズを取得
-                                original_img = get_image_from_s3(f"{folder}/original.png")
-
-                            generated_img = get_image_from_s3(f"{folder}/thumbnail.png")
-                            if not generated_img:
-                                # サムネイルがない場合はフルサイズを取得
-                                generated_img = get_image_from_s3(f"{folder}/generated.png")
+                            # 変更前と変更後のサムネイル画像（ブラウザがS3から直接取得）
+                            original_url = image_url(original_card_key)
+                            generated_url = image_url(generated_card_key)
 
                             # 画像HTML（2枚並べて表示）
-                            import base64
-                            from io import BytesIO
-
                             images_html = '<div style="display: flex; gap: 4px; margin-bottom: 8px;">'
 
                             # 変更前画像
-                            if original_img:
-                                buffered = BytesIO()
-                                original_img.save(buffered, format="PNG")
-                                img_str = base64.b64encode(buffered.getvalue()).decode()
+                            if original_url:
                                 images_html += f'''
                                 <div style="flex: 1;">
                                     <div style="font-size: 0.7em; color: #666; margin-bottom: 2px; text-align: center;">変更前</div>
-                                    <img src="data:image/png;base64,{img_str}" style="width: 100%; height: 200px; object-fit: cover; border-radius: 4px;">
+                                    <img src="{original_url}" loading="lazy" style="width: 100%; height: 200px; object-fit: cover; border-radius: 4px;">
                                 </div>
                                 '''
                             else:
                                 images_html += '<div style="flex: 1;"><div style="font-size: 0.7em; color: #666; margin-bottom: 2px; text-align: center;">変更前</div><div style="height: 200px; background-color: #f0f0f0; display: flex; align-items: center; justify-content: center; border-radius: 4px; font-size: 0.8em;">画像なし</div></div>'
 
                             # 変更後画像
-                            if generated_img:
-                                buffered = BytesIO()
-                                generated_img.save(buffered, format="PNG")
-                                img_str = base64.b64encode(buffered.getvalue()).decode()
+                            if generated_url:
                                 images_html += f'''
                                 <div style="flex: 1;">
                                     <div style="font-size: 0.7em; color: #666; margin-bottom: 2px; text-align: center;">変更後</div>
-                                    <img src="data:image/png;base64,{img_str}" style="width: 100%; height: 200px; object-fit: cover; border-radius: 4px;">
+                                    <img src="{generated_url}" loading="lazy" style="width: 100%; height: 200px; object-fit: cover; border-radius: 4px;">
                                 </div>
                                 '''
                             else:
@@ -547,28 +1155,30 @@ elif 'selected_history' in st.session_state and st.session_state.selected_histor
 
         with col_hist1:
             st.subheader("オリジナル画像")
-            with st.spinner("画像を読み込み中..."):
-                original_image = get_image_from_s3(f"{timestamp}/original.png")
-            if original_image:
-                st.image(original_image, use_container_width=True)
+            original_url = image_url(history_image_key(timestamp, metadata, "original", "original"))
+            if original_url:
+                st.image(original_url, use_container_width=True)
             else:
                 st.warning("画像が見つかりません")
 
         with col_hist2:
             st.subheader("加工画像")
-            with st.spinner("画像を読み込み中..."):
-                generated_image = get_image_from_s3(f"{timestamp}/generated.png")
-            if generated_image:
-                st.image(generated_image, use_container_width=True)
+            generated_key = history_image_key(timestamp, metadata, "generated", "generated")
+            generated_url = image_url(generated_key)
+            if generated_url:
+                st.image(generated_url, use_container_width=True)
 
                 # ダウンロードボタン
-                generated_bytes = get_image_bytes_from_s3(f"{timestamp}/generated.png")
+                with st.spinner("画像を読み込み中..."):
+                    generated_bytes = get_image_bytes_from_s3(generated_key)
                 if generated_bytes:
+                    # 旧形式の履歴はPNG、新しい履歴はJPEGで保存されている
+                    generated_ext = os.path.splitext(generated_key)[1]
                     st.download_button(
                         label="加工画像をダウンロード",
                         data=generated_bytes,
-                        file_name=f"bento_pro_{timestamp}.png",
-                        mime="image/png",
+                        file_name=f"bento_pro_{timestamp}{generated_ext}",
+                        mime="image/jpeg" if generated_ext == ".jpg" else "image/png",
                         use_container_width=True
                     )
             else:
@@ -609,10 +1219,17 @@ else:
             st.session_state.current_uploaded_file = uploaded_file.name
             st.session_state.generation_completed = False
 
-        image = Image.open(uploaded_file)
+        # プレビューと解析・サムネイル用の画像（元画像の保存には使わず、保存時はアップロードされたバイト列から読み直す）
+        preview_image = Image.open(uploaded_file)
+        # 元画像をそのまま保存できるか判定するため、回転前に形式を控えておく
+        upload_format = preview_image.format
+        # JPEG（MPOを含む）はデコード時に1/2〜1/8へ縮小（長辺1024px以上は維持され、フル解像度のデコードを回避）
+        if preview_image.format in ('JPEG', 'MPO'):
+            preview_image.draft('RGB', (1024, 1024))
         # Exif情報に基づいて自動回転（プレビューでも向きを維持）
-        image = ImageOps.exif_transpose(image)
-        st.image(image, caption="アップロードされた画像", width=400)
+        # in_place=True: 回転不要な画像でフル解像度のコピーを作らない。以降の処理は回転済みの preview_image を前提とする
+        ImageOps.exif_transpose(preview_image, in_place=True)
+        st.image(preview_image, caption="アップロードされた画像", width=400)
 
     # スタイル選択オプション
     st.markdown("---")
@@ -672,7 +1289,7 @@ else:
     st.markdown("#### 容器の汚れ補正")
     container_clean = st.radio(
         "container_clean_label",
-        ["補正なし", "容器汚れを補正"],
+        ["補正なし", CONTAINER_CLEAN_OPTION],
         horizontal=True,
         label_visibility="collapsed"
     )
@@ -690,6 +1307,8 @@ else:
     if uploaded_file and not st.session_state.generation_completed:
         if st.button("写真を加工する", type="primary", use_container_width=True):
             st.session_state.processing = True
+            timestamp = None
+            uploads = []
             try:
                 start_time = time.time()  # 全体開始時間
 
@@ -702,151 +1321,103 @@ else:
                 progress_bar.progress(33)
                 step1_start = time.time()
 
-                # 画像をバイトデータに変換（軽量化）
+                # 画像をJPEGのバイトデータに変換（軽量化。解析結果キャッシュのキーにも使用）
                 img_byte_arr = io.BytesIO()
                 # 長辺を1024pxにリサイズして軽量化
-                image_copy = image.copy()
-                # Exif情報に基づいて自動回転（向きを維持）
-                image_copy = ImageOps.exif_transpose(image_copy)
-                image_copy.thumbnail((1024, 1024))
+                # （preview_image はアップロード時にExif回転済みのため再度の回転は不要）
+                image_copy = downscale_image(preview_image, (1024, 1024))
                 # RGBA形式の場合はRGBに変換してからJPEG保存
                 if image_copy.mode == 'RGBA':
                     image_copy = image_copy.convert('RGB')
-                image_copy.save(img_byte_arr, format='JPEG')
-                img_byte_arr.seek(0)  # ストリームを先頭に戻す
-
-                # Vision APIで解析（容器・配置・食材を明確に指示）
-                vision_prompt = """
-                Analyze this bento image for a commercial photography prompt.
-                Extract the following visual details accurately:
-
-                1. CONTAINER: Describe the material, shape, color, and pattern of the bento box (e.g., wood-grain paper box, black plastic, round, rectangular).
-                2. LAYOUT: Describe specifically where each food item is placed (e.g., Grilled salmon on the center-left, Tamagoyaki on the top-right).
-                3. FOOD: List all food items with visual details (texture, color).
-
-                IMPORTANT: Do NOT describe the camera angle, shooting angle, or perspective (e.g., high-angle, overhead, low-angle).
-                Only describe the container, food arrangement, and food details.
-
-                Format the output as a descriptive paragraph for image generation.
-                Answer in English.
-                """
-
-                # 新SDK: Gemini Vision Model で画像解析 + Thinking mode最適化
-                # response = client.models.generate_content(
-                #     model='gemini-3-flash-preview',
-                #     contents=[vision_prompt, Image.open(img_byte_arr)],
-                #     config=types.GenerateContentConfig(
-                #         thinking_config=types.ThinkingConfig(thinking_level="medium")
-                #     )
-                # )
-
-                response = client.models.generate_content(
-                    model='gemini-3-pro-preview',
-                    contents=[vision_prompt, Image.open(img_byte_arr)],
-                    config=types.GenerateContentConfig(
-                        thinking_config=types.ThinkingConfig(thinking_level="high")
-                    )
-                )
-
-                analyzed_content = response.text.strip()
-
-                # メタデータ生成（タイトル、説明、タグ）
-                metadata_prompt = """
-                Based on this bento description, generate the following metadata in JSON format:
-                - title: A short Japanese title (max 20 characters, e.g., "ハンバーグ弁当", "幕の内弁当")
-                - description: A brief Japanese description (max 50 characters)
-                - tags: An array of 3-5 Japanese search tags (e.g., ["ハンバーグ", "和食", "唐揚げ"])
-
-                Return ONLY valid JSON in this exact format:
-                {
-                  "title": "...",
-                  "description": "...",
-                  "tags": ["...", "...", "..."]
+                image_copy.save(img_byte_arr, format='JPEG', quality=85)
+                jpeg_bytes = img_byte_arr.getvalue()
+                # エンコード済みのJPEGをそのまま送信（SDK側での再エンコードを回避）
+                img_part = types.Part.from_bytes(data=jpeg_bytes, mime_type='image/jpeg')
+
+                # 履歴保存（S3）の準備
+                timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+
+                # 元画像はアップロードされた形式のまま、それ以外は軽量なJPEGで保存
+                passthrough = ORIGINAL_PASSTHROUGH_FORMATS.get(upload_format)
+                # 位置情報などのメタデータを取り除けない画像は再エンコードして保存する
+                original_data = strip_image_metadata(uploaded_file.getvalue(), upload_format) if passthrough else None
+                if original_data is None:
+                    passthrough = None
+                history_files = {
+                    "original": f"original{passthrough[0]}" if passthrough else "original.jpg",
+                    "original_thumbnail": "original_thumbnail.jpg",
+                    "generated": "generated.jpg",
+                    "thumbnail": "thumbnail.jpg",
                 }
+                original_key = f"{timestamp}/{history_files['original']}"
 
-                Bento description:
-                """ + analyzed_content
-
-                metadata_response = client.models.generate_content(
-                    model='gemini-2.0-flash-exp',
-                    contents=metadata_prompt
-                )
+                # 元画像とそのサムネイルは解析・加工を待たずにバックグラウンドでS3に保存
+                # （JPEG/PNGは再エンコードせず、位置情報などのメタデータだけを取り除いて保存）
+                if passthrough:
+                    original_upload = submit_in_thread(save_bytes_to_s3, original_data, original_key, passthrough[1])
+                else:
+                    # preview_image は draft() で縮小されている場合があるため、元のバイト列から読み直す
+                    original_upload = submit_in_thread(save_original_image_to_s3, uploaded_file.getvalue(), original_key)
+                # サムネイルはフル解像度ではなく縮小済みの1024px画像から生成
+                original_thumbnail_upload = submit_in_thread(save_thumbnail_to_s3, image_copy, f"{timestamp}/{history_files['original_thumbnail']}")
+                uploads = [original_upload, original_thumbnail_upload]
+
+                # 解析結果のキャッシュ（同じ画像・同じモデル・同じプロンプトなら再解析しない）
+                # 高速モードでは解析せず、既定のメタデータで画像生成に進む
+                if fast_mode:
+                    analysis_cache = {"analyzed_content": "", "metadata": {"title": "弁当", "description": "", "tags": []}}
+                else:
+                    image_hash = hashlib.sha256(jpeg_bytes).hexdigest()
+                    prompt_version = hashlib.sha256(
+                        f"{VISION_MODEL}{vision_think}{VISION_PROMPT}{json.dumps(VISION_RESPONSE_SCHEMA)}".encode('utf-8')
+                    ).hexdigest()[:12]
+                    analysis_cache = get_analysis_cache(image_hash, prompt_version)
+
+                if analysis_cache:
+                    analyzed_content = analysis_cache["analyzed_content"]
+                    metadata_dict = analysis_cache["metadata"]
+                else:
+                    # 新SDK: Gemini Vision Model で画像解析 + Thinking mode最適化
+                    vision_result = analyze_image(img_part, VISION_PROMPT, VISION_RESPONSE_SCHEMA, vision_think)
+                    analyzed_content = vision_result["analyzed_content"].strip()
+                    metadata_dict = {
+                        "title": vision_result["title"],
+                        "description": vision_result["description"],
+                        "tags": vision_result["tags"]
+                    }
 
-                # JSONをパース
-                import json
-                metadata_text = metadata_response.text.strip()
-                # マークダウンのコードブロックを削除
-                if metadata_text.startswith("```"):
-                    metadata_text = metadata_text.split("```")[1]
-                    if metadata_text.startswith("json"):
-                        metadata_text = metadata_text[4:]
-                metadata_dict = json.loads(metadata_text.strip())
+                    save_analysis_cache(image_hash, prompt_version, {
+                        "analyzed_content": analyzed_content,
+                        "metadata": metadata_dict
+                    })
 
                 step1_time = time.time() - step1_start
 
-                st.success(f"解析完了 ({step1_time:.2f}秒): {metadata_dict['title']} - {analyzed_content[:80]}...")
+                if not fast_mode:
+                    st.success(f"解析完了 ({step1_time:.2f}秒): {metadata_dict['title']} - {analyzed_content[:80]}...")
 
                 # Step 2: プロンプト合成
                 status_text.text("Step 2/3: プロンプトを合成中...")
                 progress_bar.progress(66)
 
-                # 背景設定
-                background_map = {
-                    "白背景": "clean white background",
-                    "黒背景": "matte black background",
-                    "木目テーブル": "natural wood grain table surface",
-                    "大理石": "elegant marble table surface",
-                    "和紙": "traditional Japanese washi paper background"
-                }
-
-                # 撮影角度設定（y軸方向：カメラの高さ/俯瞰度）
-                angle_map = {
-                    "斜め45度": "The camera is positioned at a moderate height above the table, looking down at the bento box at approximately 30-40 degrees from horizontal. This angle shows both the top surface of the food AND the front vertical side wall of the container clearly, creating depth while maintaining visibility of contents.",
-                    "真上俯瞰": "The camera is positioned DIRECTLY overhead at 90 degrees, perfectly perpendicular to the table surface. Pure bird's eye view looking STRAIGHT DOWN. NO angle whatsoever - completely flat, top-down perspective."
-                }
-
-                # 弁当の向き設定（テーブル上での物理的な配置）
-                rotation_map = {
-                    "正面配置": {
-                        "rule": "**[Crucial: Orientation & Alignment]**\n* The bento box is NOT rotated diagonally on the table surface.\n* The edges of the box are perfectly parallel to the frame edges (top edge parallel to top of frame, sides parallel to sides of frame).\n* NO rotation whatsoever. The box maintains a straight, unrotated position.",
-                        "description": "The box faces the camera squarely."
-                    },
-                    "斜め配置": {
-                        "rule": "**[Crucial: Orientation & Alignment]**\n* The bento box IS rotated diagonally on the table surface.\n* The box is tilted approximately 45 degrees CLOCKWISE (from viewer's perspective).\n* One corner of the box points towards the top of the frame, creating a diamond-like orientation.",
-                        "description": "Creates dynamic diagonal depth."
-                    }
-                }
-
-                # 照明設定
-                lighting_map = {
-                    "明るいスタジオ": "Bright, even studio lighting (high-key). Soft shadows. The food looks fresh, glossy, vibrant, and appetizing.",
-                    "柔らか自然光": "Soft, natural window light. Gentle shadows. The food looks fresh, natural, and inviting.",
-                    "ドラマチック": "Dramatic side lighting with strong shadows. The food looks bold, artistic, and textured."
-                }
-
-                # 余白設定（構図の概念で指定し、縁が見切れないことを保証）
-                margin_map = {
-                    "標準": "With some negative space around the bento box. A little breathing room on the table surface. Not cropped tightly. Centered composition. The entire bento box must fit completely within the frame with NO edges cut off.",
-                    "広い": "Ample negative space. Vast empty table surface surrounding the bento box. Minimalist composition with lots of empty space. Long shot. The bento box is small in the center of the large frame. The entire bento box must fit completely within the frame with NO edges cut off."
-                }
-
                 # プロンプト構成: 重要ルール → カメラ設定 → 配置 → 照明 → 内容
 
                 # 1. 弁当の向き（最優先ルール）
-                rotation_rule = rotation_map[rotation]["rule"]
-                rotation_desc = rotation_map[rotation]["description"]
+                rotation_rule = ROTATION_MAP[rotation]["rule"]
+                rotation_desc = ROTATION_MAP[rotation]["description"]
 
                 # 2. カメラ設定
-                camera_setup = f"**[Camera Angle & Perspective]**\n* {angle_map[angle]}"
+                camera_setup = f"**[Camera Angle & Perspective]**\n* {ANGLE_MAP[angle]}"
 
                 # 3. 背景と余白
-                environment = f"**[Environment & Composition]**\n* The bento box is placed on a {background_map[background]}.\n* {margin_map[margin]}"
+                environment = f"**[Environment & Composition]**\n* The bento box is placed on a {BACKGROUND_MAP[background]}.\n* {MARGIN_MAP[margin]}"
 
                 # 4. 照明
-                lighting_section = f"**[Lighting & Style]**\n* {lighting_map[lighting]}\n* NO steam, NO vapor. 8k resolution, highly detailed."
+                lighting_section = f"**[Lighting & Style]**\n* {LIGHTING_MAP[lighting]}\n* NO steam, NO vapor. 8k resolution, highly detailed."
 
-                # 5. 内容
-                content_part = f"**[Contents Description]**\n{analyzed_content}"
+                # 5. 内容（高速モードでは解析結果の代わりに元画像の観察を指示）
+                contents_description = analyzed_content or FAST_MODE_CONTENT_INSTRUCTION
+                content_part = f"**[Contents Description]**\n{contents_description}"
 
                 # 最終プロンプト（ルール → カメラ → 環境 → 照明 → 内容の順）
                 final_prompt = f"Professional commercial food photography.\n\n{rotation_rule}\n\n{camera_setup}\n\n{environment}\n\n{lighting_section}\n\n{content_part}"
@@ -857,15 +1428,7 @@ else:
                 step3_start = time.time()
 
                 # 容器清掃指示（選択された場合のみ）
-                container_clean_instruction = ""
-                if container_clean == "汚れを補正":
-                    container_clean_instruction = """
-CONTAINER CLEANING:
-- Clean any sauce stains, oil marks, or liquid spills on the bento box container surfaces (walls, edges, exterior)
-- The container should look pristine and clean
-- CRITICAL: Do NOT alter, change, or modify the food contents inside the compartments
-- Only clean the container itself, not the food
-"""
+                container_clean_instruction = CONTAINER_CLEAN_INSTRUCTION if container_clean == CONTAINER_CLEAN_OPTION else ""
 
                 # 画像参照型プロンプト（元画像を見ながらスタイルだけを変換）
                 reference_prompt = f"""
@@ -886,77 +1449,42 @@ Refine this specific image into a professional commercial food photography style
 {container_clean_instruction}
 
 **[Contents Description]**
-{analyzed_content}
+{contents_description}
 """
 
-                # 画像ストリームを先頭に戻す
-                img_byte_arr.seek(0)
-
-                # アスペクト比マッピング（プロンプト用）
-                aspect_ratio_prompt_map = {
-                    "正方形(1:1)": "**[Output Format]**\nGenerate the output image in SQUARE format with 1:1 aspect ratio (width equals height).",
-                    "縦長(3:4)": "**[Output Format]**\nGenerate the output image in PORTRAIT/VERTICAL format with 3:4 aspect ratio (width:height = 3:4, taller than wide).",
-                    "横長(4:3)": "**[Output Format]**\nGenerate the output image in LANDSCAPE/HORIZONTAL format with 4:3 aspect ratio (width:height = 4:3, wider than tall)."
-                }
-
                 # アスペクト比指定をプロンプトに追加
-                reference_prompt_with_aspect = f"{reference_prompt}\n\n{aspect_ratio_prompt_map[aspect_ratio]}"
+                reference_prompt_with_aspect = f"{reference_prompt}\n\n{ASPECT_RATIO_PROMPT_MAP[aspect_ratio]}"
 
                 # 新SDK: Gemini 3 Pro Image で画像生成
-                generation_response = client.models.generate_content(
-                    model='gemini-3-pro-image-preview',
-                    contents=[
-                        reference_prompt_with_aspect,
-                        Image.open(img_byte_arr)
-                    ]
-                )
+                generation_response = generate_image(reference_prompt_with_aspect, img_part)
 
                 # 生成された画像を表示
                 if generation_response.candidates:
                     step3_time = time.time() - step3_start
                     total_time = time.time() - start_time
 
-                    generated_image_data = generation_response.candidates[0].content.parts[0].inline_data.data
+                    # 生成された画像のバイト列は表示・ダウンロード・保存で使い回し、再エンコードしない
+                    generated_inline = generation_response.candidates[0].content.parts[0].inline_data
+                    generated_image_data = generated_inline.data
+                    generated_mime = generated_inline.mime_type or 'image/png'
                     generated_image = Image.open(io.BytesIO(generated_image_data))
 
                     with result_placeholder.container():
-                        st.image(generated_image, caption="加工後の写真", width=600)
+                        st.image(generated_image_data, caption="加工後の写真", width=600)
 
                         # ダウンロードボタン
-                        buf = io.BytesIO()
-                        generated_image.save(buf, format="PNG")
-                        byte_im = buf.getvalue()
-
                         st.download_button(
                             label="画像をダウンロード",
-                            data=byte_im,
-                            file_name="bento_pro.png",
-                            mime="image/png",
+                            data=generated_image_data,
+                            file_name="bento_pro.jpg" if generated_mime == 'image/jpeg' else "bento_pro.png",
+                            mime=generated_mime,
                             width='stretch'
                         )
 
-                    # 履歴保存（S3）
-                    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-
-                    # 元画像をS3に保存
-                    save_image_to_s3(image, f"{timestamp}/original.png")
-
-                    # 元画像のサムネイル生成（長辺400px）
-                    original_thumbnail = image.copy()
-                    original_thumbnail.thumbnail((400, 400), Image.Resampling.LANCZOS)
-                    save_image_to_s3(original_thumbnail, f"{timestamp}/original_thumbnail.png")
-
-                    # 生成画像をS3に保存
-                    save_image_to_s3(generated_image, f"{timestamp}/generated.png")
-
-                    # 生成画像のサムネイル生成（長辺400px）
-                    thumbnail = generated_image.copy()
-                    thumbnail.thumbnail((400, 400), Image.Resampling.LANCZOS)
-                    save_image_to_s3(thumbnail, f"{timestamp}/thumbnail.png")
-
-                    # メタデータを保存
+                    # メタデータ
                     metadata = {
                         "timestamp": timestamp,
+                        "files": history_files,
                         "title": metadata_dict.get("title", "弁当"),
                         "description": metadata_dict.get("description", ""),
                         "tags": metadata_dict.get("tags", []),
@@ -974,25 +1502,62 @@ Refine this specific image into a professional commercial food photography style
                         "step3_time": step3_time,
                         "total_time": total_time
                     }
-                    save_metadata_to_s3(metadata, f"{timestamp}/metadata.json")
 
-                    status_text.success(f"加工完了 | 解析: {step1_time:.2f}秒 | 加工: {step3_time:.2f}秒 | 合計: {total_time:.2f}秒")
-                    progress_bar.empty()
-                    st.session_state.processing = False
-                    st.session_state.generation_completed = True
-
-                    # 生成完了後、履歴詳細ページへ遷移
-                    st.session_state.selected_history = timestamp
-                    st.query_params['history'] = timestamp
-                    time.sleep(1)
-                    st.rerun()
+                    # 生成画像・サムネイル・メタデータを並列でS3に保存し、先行した元画像の保存と合わせて完了を待つ
+                    # （複数スレッドから参照するため、遅延読み込みの画像は先にデコードしておく）
+                    generated_image.load()
+                    generated_key = f"{timestamp}/{history_files['generated']}"
+                    if generated_mime == 'image/jpeg':
+                        # JPEGで返ってきた場合はそのまま保存
+                        generated_upload = submit_in_thread(save_bytes_to_s3, generated_image_data, generated_key, generated_mime)
+                    else:
+                        # PNGなどは履歴を軽量に保つためJPEGに変換して保存
+                        generated_upload = submit_in_thread(save_image_to_s3, generated_image, generated_key)
+                    thumbnail_upload = submit_in_thread(save_thumbnail_to_s3, generated_image, f"{timestamp}/{history_files['thumbnail']}")
+                    uploads += [generated_upload, thumbnail_upload]
+
+                    # サムネイルの保存に失敗した場合は、一覧でフルサイズ画像を表示するよう files を書き換えてからメタデータを保存
+                    if not original_thumbnail_upload.result():
+                        history_files["original_thumbnail"] = history_files["original"]
+                    if not thumbnail_upload.result():
+                        history_files["thumbnail"] = history_files["generated"]
+                    metadata_upload = submit_in_thread(save_metadata_to_s3, metadata, f"{timestamp}/metadata.json")
+                    uploads.append(metadata_upload)
+                    wait(uploads)
+
+                    # 元画像・生成画像・メタデータが保存できていれば履歴として登録（サムネイルは一覧で元画像に代替できるため任意）
+                    # 元画像が保存できなかった場合は、代替先のないサムネイル参照ごと破棄する
+                    if not (original_upload.result() and generated_upload.result() and metadata_upload.result()):
+                        discard_partial_history(timestamp, uploads)
+                        st.error("加工結果の保存に失敗しました。もう一度お試しください。")
+                        status_text.empty()
+                        progress_bar.empty()
+                        st.session_state.processing = False
+                    elif not update_history_index(add=timestamp):
+                        st.error("加工結果は保存されましたが、履歴一覧への登録に失敗しました。")
+                        status_text.empty()
+                        progress_bar.empty()
+                        st.session_state.processing = False
+                    else:
+                        status_text.success(f"加工完了 | 解析: {step1_time:.2f}秒 | 加工: {step3_time:.2f}秒 | 合計: {total_time:.2f}秒")
+                        progress_bar.empty()
+                        st.session_state.processing = False
+                        st.session_state.generation_completed = True
+
+                        # 生成完了後、履歴詳細ページへ遷移
+                        st.session_state.selected_history = timestamp
+                        st.query_params['history'] = timestamp
+                        time.sleep(1)
+                        st.rerun()
                 else:
+                    discard_partial_history(timestamp, uploads)
                     st.error("画像加工に失敗しました。もう一度お試しください。")
                     status_text.empty()
                     progress_bar.empty()
                     st.session_state.processing = False
 
             except Exception as e:
+                discard_partial_history(timestamp, uploads)
                 st.error(f"エラーが発生しました: {str(e)}")
                 st.info("API KeyやモデルIDを確認してください。")
                 status_text.empty()
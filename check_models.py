@@ -1,10 +1,15 @@
 import google.generativeai as genai
+import argparse
 import os
 from dotenv import load_dotenv
 
 # 環境変数読み込み
 load_dotenv()
 
+parser = argparse.ArgumentParser(description='利用可能なGeminiモデルを一覧表示')
+parser.add_argument('--verbose', action='store_true', help='モデルごとのサポート機能も表示')
+args = parser.parse_args()
+
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 
 if not GOOGLE_API_KEY:
@@ -20,20 +25,20 @@ print("📋 利用可能なGeminiモデル一覧")
 print("=" * 60)
 
 try:
-    models = genai.list_models()
+    # 1ページあたりの件数を増やしてページング回数を減らし、一覧は一度だけ取得
+    models = list(genai.list_models(page_size=100))
 
     vision_models = []
     generation_models = []
-    other_models = []
 
+    # 先に分類だけを行い、表示はまとめて最後に行う
     for model in models:
         model_name = model.name.replace('models/', '')
+        supported_methods = model.supported_generation_methods
 
-        # サポートされているメソッドを確認
-        supported_methods = [method for method in model.supported_generation_methods]
-
-        print(f"\n🔹 {model_name}")
-        print(f"   サポート機能: {', '.join(supported_methods)}")
+        if args.verbose:
+            print(f"\n🔹 {model_name}")
+            print(f"   サポート機能: {', '.join(supported_methods)}")
 
         # Vision（画像解析）対応モデル
         if 'generateContent' in supported_methods:
@@ -44,6 +49,9 @@ try:
         if 'imagen' in model_name.lower() or 'generate' in model_name.lower():
             generation_models.append(model_name)
 
+    vision_models.sort()
+    generation_models.sort()
+
     print("\n" + "=" * 60)
     print("📊 推奨モデル")
     print("=" * 60)
@@ -6,15 +6,31 @@ original_thumbnail.png が存在しない履歴に対して、original.png か
 使用方法:
   python generate_thumbnails.py                                      # .envのバケットを使用
   python generate_thumbnails.py --bucket bento-pro-generator-production  # 本番バケットを指定
+  python generate_thumbnails.py --concurrency 64                     # 並列数を指定
+  python generate_thumbnails.py --inventory s3://.../manifest.json   # S3インベントリから一覧
+  python generate_thumbnails.py --resume thumbnails_manifest.json    # 前回の続きから処理
 """
 
 import os
 import io
+import csv
+import gzip
+import json
+import re
 import argparse
+import queue
+import threading
+from collections import defaultdict
+from urllib.parse import unquote_plus
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+import PIL
 from PIL import Image
 from dotenv import load_dotenv
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
 
 # 環境変数の読み込み
 load_dotenv()
@@ -25,8 +41,43 @@ AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
 S3_REGION = os.getenv("S3_REGION")
 
+# 履歴フォルダではないフォルダ（app.py の画像解析キャッシュ）
+CACHE_FOLDER = "cache"
+# cache/ 配下のどのキーよりも後ろに並ぶキー（一覧時に StartAfter に指定して cache/ を丸ごと読み飛ばす）
+CACHE_FOLDER_SKIP_KEY = f"{CACHE_FOLDER}/\U0010ffff"
+# app.py が作成する履歴フォルダ名（タイムスタンプ）の形式
+HISTORY_FOLDER_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}")
+
+# サムネイルのサイズ（長辺400px）
+THUMBNAIL_SIZE = (400, 400)
+
+# フォルダを並列処理するスレッド数のデフォルト（S3の通信待ちが大半のため多めに設定）
+DEFAULT_CONCURRENCY = 32
+
+# Pillow-SIMD（バージョンに .postN が付く）が入っていればLANCZOS縮小がSIMD化されて高速になる
+# 導入: pip uninstall pillow && pip install pillow-simd（APIは同一のためコード変更は不要）
+PILLOW_SIMD = ".post" in PIL.__version__
+
+# サムネイル生成（デコード・縮小・エンコード）を行うプロセス数（GILの影響を受けないようプロセスで並列化）
+CPU_WORKERS = os.cpu_count() or 4
+
 # グローバル変数（後でコマンドライン引数で上書き可能）
 BUCKET_NAME = S3_BUCKET_NAME
+# サムネイル生成用のプロセスプール（main() で作成）
+cpu_pool = None
+
+# S3クライアント設定（全スレッドで1つのクライアントを共有する）
+S3_CLIENT_CONFIG = Config(
+    # 並列処理のスレッドが接続待ちにならないよう上限を拡張（デフォルトは10）
+    max_pool_connections=64,
+    # TCP keep-aliveでアイドル後の再接続（TLSハンドシェイク）を抑制
+    tcp_keepalive=True,
+    # 並列数が多いとスロットリング（SlowDown）が起きやすいため、送信ペースも自動調整する
+    retries={'max_attempts': 10, 'mode': 'adaptive'}
+)
+
+# クライアントの再試行でも解消しなかった一時的なエラー（フォルダ単位で再試行する）
+TRANSIENT_S3_ERROR_CODES = {'SlowDown', 'InternalError', 'RequestTimeout', 'ServiceUnavailable'}
 
 # S3クライアント初期化
 if AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY:
@@ -34,98 +85,233 @@ if AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY:
         's3',
         aws_access_key_id=AWS_ACCESS_KEY_ID,
         aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-        region_name=S3_REGION
+        region_name=S3_REGION,
+        config=S3_CLIENT_CONFIG
     )
 else:
     print("エラー: AWS認証情報が設定されていません")
     exit(1)
 
 
-def list_history_folders():
-    """S3から履歴フォルダ一覧を取得"""
+def _add_history_file(folders, key):
+    """S3のキーを履歴フォルダ名とファイル名に分けて folders に追加"""
+    folder, sep, name = key.partition('/')
+    # 直下のファイル（index.json など）と画像解析キャッシュ用のフォルダ（cache/）は履歴ではないため除外
+    if sep and folder != CACHE_FOLDER:
+        folders[folder].add(name)
+
+
+def list_history_folders(prefix="", start_after=""):
+    """S3のバケット全体（prefix 指定時はその配下のみ）を一覧し、履歴フォルダごとのファイル名の集合を取得
+    start_after を指定するとそれより後（新しい履歴）だけを一覧する"""
+    # 1回の一覧で全フォルダのファイル有無が分かるため、フォルダごとのHEADリクエストが不要になる
+    folders = defaultdict(set)
     try:
-        response = s3_client.list_objects_v2(Bucket=BUCKET_NAME, Delimiter='/')
-        if 'CommonPrefixes' not in response:
-            return []
-        folders = [prefix['Prefix'].rstrip('/') for prefix in response['CommonPrefixes']]
-        return sorted(folders)
+        paginator = s3_client.get_paginator('list_objects_v2')
+        while True:
+            list_args = {'Bucket': BUCKET_NAME, 'Prefix': prefix}
+            if start_after:
+                list_args['StartAfter'] = start_after
+            reached_cache = False
+            for page in paginator.paginate(**list_args):
+                for obj in page.get('Contents', []):
+                    # 画像解析キャッシュ（cache/）は件数が多く履歴でもないため、最初のキーが見えたら
+                    # 一覧をやり直して StartAfter で読み飛ばす（cache/ より後ろに並ぶ履歴フォルダも取りこぼさない）
+                    if obj['Key'].startswith(f"{CACHE_FOLDER}/"):
+                        reached_cache = True
+                        break
+                    _add_history_file(folders, obj['Key'])
+                if reached_cache:
+                    break
+            if not reached_cache:
+                return dict(sorted(folders.items()))
+            start_after = CACHE_FOLDER_SKIP_KEY
     except ClientError as e:
         print(f"S3リストエラー: {str(e)}")
-        return []
+        return {}
 
 
-def check_file_exists(key):
-    """S3上にファイルが存在するかチェック"""
+def list_history_folders_from_inventory(manifest_uri):
+    """S3インベントリ（CSV形式）のマニフェストから履歴フォルダごとのファイル名の集合を取得"""
+    # 大量のLISTリクエストの代わりに、インベントリのファイルをダウンロードするだけで一覧できる
+    manifest_bucket, _, manifest_key = manifest_uri.removeprefix("s3://").partition('/')
+    folders = defaultdict(set)
     try:
-        s3_client.head_object(Bucket=BUCKET_NAME, Key=key)
-        return True
-    except ClientError:
-        return False
+        response = s3_client.get_object(Bucket=manifest_bucket, Key=manifest_key)
+        manifest = json.loads(response['Body'].read())
+        if manifest.get('fileFormat') != 'CSV':
+            print(f"インベントリエラー: CSV形式のみ対応しています（{manifest.get('fileFormat')}）")
+            return {}
+        key_index = [column.strip() for column in manifest['fileSchema'].split(',')].index('Key')
+        inventory_bucket = manifest['destinationBucket'].removeprefix('arn:aws:s3:::')
+        for inventory_file in manifest['files']:
+            body = s3_client.get_object(Bucket=inventory_bucket, Key=inventory_file['key'])['Body']
+            with gzip.open(body, 'rt', encoding='utf-8', newline='') as rows:
+                for row in csv.reader(rows):
+                    # インベントリのキーはURLエンコードされている
+                    _add_history_file(folders, unquote_plus(row[key_index]))
+        return dict(sorted(folders.items()))
+    except ClientError as e:
+        print(f"S3インベントリ取得エラー: {str(e)}")
+        return {}
+
+
+# 並列処理中のログは1つの書き込みスレッドにまとめ、処理スレッドが標準出力の書き込み待ちで止まらないようにする
+_log_queue = queue.Queue()
+
+
+def log(message):
+    """ログを書き込みスレッドに渡す（並列処理中はprintの代わりに使う）"""
+    _log_queue.put(message)
+
 
+def _write_logs():
+    """キューに積まれたログを順に出力（None を受け取ったら終了）"""
+    for message in iter(_log_queue.get, None):
+        print(message)
 
-def get_image_from_s3(key):
-    """S3から画像を取得"""
+
+def load_resume_state(path):
+    """前回実行時の記録（一覧済みの最後のフォルダとエラーになったフォルダ）を読み込む"""
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f).get(BUCKET_NAME, {})
+
+
+def save_resume_state(path, state):
+    """実行結果の記録を保存（書き込み途中で中断しても壊れないよう一時ファイルから置き換える）"""
+    manifest = {}
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            manifest = json.load(f)
+    manifest[BUCKET_NAME] = state
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _is_transient_s3_error(error):
+    """一時的なS3エラーかどうかを判定"""
+    return isinstance(error, ClientError) and error.response.get('Error', {}).get('Code') in TRANSIENT_S3_ERROR_CODES
+
+
+# 一時的なエラーは少し待ってから再試行し、スクリプト全体の再実行を不要にする
+s3_retry = retry(
+    retry=retry_if_exception(_is_transient_s3_error),
+    wait=wait_random_exponential(multiplier=0.2, max=5),
+    stop=stop_after_attempt(3),
+    reraise=True
+)
+
+
+@s3_retry
+def _put_object(key, body, content_length, content_type):
+    """S3にオブジェクトをアップロード（再試行時もバッファの先頭から送る）"""
+    body.seek(0)
+    s3_client.put_object(
+        Bucket=BUCKET_NAME,
+        Key=key,
+        Body=body,
+        ContentLength=content_length,
+        ContentType=content_type
+    )
+
+
+def get_bytes_from_s3(key):
+    """S3からファイルのバイナリデータを取得"""
     try:
-        response = s3_client.get_object(Bucket=BUCKET_NAME, Key=key)
-        return Image.open(io.BytesIO(response['Body'].read()))
+        response = s3_retry(s3_client.get_object)(Bucket=BUCKET_NAME, Key=key)
+        return response['Body'].read()
     except ClientError as e:
-        print(f"  画像取得エラー ({key}): {str(e)}")
+        log(f"  画像取得エラー ({key}): {str(e)}")
         return None
 
 
-def save_image_to_s3(image, key):
-    """画像をS3にアップロード"""
+def save_bytes_to_s3(data, key, content_type):
+    """エンコード済みのデータをS3にアップロード"""
     try:
-        img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, format='PNG')
-        img_byte_arr.seek(0)
-        s3_client.upload_fileobj(
-            img_byte_arr,
-            BUCKET_NAME,
-            key,
-            ExtraArgs={'ContentType': 'image/png'}
+        # サムネイルはマルチパートの閾値より十分小さいため、転送マネージャーを介さず1回のPUTで送る
+        _put_object(key, io.BytesIO(data), len(data), content_type)
+        return True
+    except ClientError as e:
+        log(f"  S3アップロードエラー ({key}): {str(e)}")
+        return False
+
+
+def copy_object_in_s3(source_key, key):
+    """S3上でオブジェクトをコピー（データはS3内で複製され、手元を経由しない）"""
+    try:
+        s3_retry(s3_client.copy_object)(
+            Bucket=BUCKET_NAME,
+            Key=key,
+            CopySource={'Bucket': BUCKET_NAME, 'Key': source_key}
         )
         return True
     except ClientError as e:
-        print(f"  S3アップロードエラー ({key}): {str(e)}")
+        log(f"  S3コピーエラー ({key}): {str(e)}")
         return False
 
 
-def generate_thumbnail_for_folder(folder):
-    """指定されたフォルダのサムネイルを生成"""
+def make_thumbnail(data):
+    """画像データから長辺400pxのサムネイル(PNG)を生成（プロセスプールで実行するため入出力はバイト列）"""
+    image = Image.open(io.BytesIO(data))
+    # copy() でフル解像度をデコードせず、未読み込みの画像に直接 thumbnail() をかける
+    # （JPEGは thumbnail() 内の draft() により縮小デコードされる）
+    # reducing_gap=2.0: 目標サイズの2倍までは整数倍の reduce() で粗く縮小し、残りだけをLANCZOSで仕上げる
+    image.thumbnail(THUMBNAIL_SIZE, Image.Resampling.LANCZOS, reducing_gap=2.0)
+    img_byte_arr = io.BytesIO()
+    # サムネイルは小さいため圧縮率より速度を優先（デフォルトの6より数倍速い）
+    image.save(img_byte_arr, format='PNG', compress_level=1)
+    return img_byte_arr.getvalue()
+
+
+def has_thumbnail(files):
+    """サムネイルが既に存在するか（新しい履歴はJPEGで保存されている）"""
+    return "original_thumbnail.png" in files or "original_thumbnail.jpg" in files
+
+
+def generate_thumbnail_for_folder(folder, files):
+    """指定されたフォルダのサムネイルを生成（files はフォルダ内のファイル名の集合）"""
     original_thumbnail_key = f"{folder}/original_thumbnail.png"
     original_key = f"{folder}/original.png"
 
-    # original_thumbnail.png が既に存在するかチェック
-    if check_file_exists(original_thumbnail_key):
-        print(f"  [スキップ] {folder}: サムネイル既に存在")
-        return "skip"
+    # original.png が存在するかチェック（新形式の履歴など、再実行しても解消しないため "error" とは区別する）
+    if "original.png" not in files:
+        log(f"  [対象外] {folder}: original.png が存在しません")
+        return "missing"
 
-    # original.png が存在するかチェック
-    if not check_file_exists(original_key):
-        print(f"  [エラー] {folder}: original.png が存在しません")
+    # original.png を取得
+    log(f"  [処理中] {folder}: サムネイル生成中...")
+    original_data = get_bytes_from_s3(original_key)
+    if not original_data:
         return "error"
 
-    # original.png を取得
-    print(f"  [処理中] {folder}: サムネイル生成中...")
-    original_image = get_image_from_s3(original_key)
-    if not original_image:
+    # 元画像がサムネイルサイズ以下なら縮小しても同じ画像になるため、S3上でそのままコピー
+    # （サイズはヘッダーから分かるため、画像のデコード・エンコードは行わない）
+    with Image.open(io.BytesIO(original_data)) as original_image:
+        original_size = original_image.size
+    if original_size[0] <= THUMBNAIL_SIZE[0] and original_size[1] <= THUMBNAIL_SIZE[1]:
+        if copy_object_in_s3(original_key, original_thumbnail_key):
+            log(f"  [完了] {folder}: 元画像をサムネイルとしてコピー")
+            return "success"
         return "error"
 
-    # サムネイル生成（長辺400px）
-    thumbnail = original_image.copy()
-    thumbnail.thumbnail((400, 400), Image.Resampling.LANCZOS)
+    # サムネイル生成（長辺400px）はCPU用のプロセスプールに渡し、
+    # その間も他のフォルダのダウンロード・アップロードは通信用のスレッドで進める
+    thumbnail_data = cpu_pool.submit(make_thumbnail, original_data).result()
 
     # S3にアップロード
-    if save_image_to_s3(thumbnail, original_thumbnail_key):
-        print(f"  [完了] {folder}: サムネイル生成完了")
+    if save_bytes_to_s3(thumbnail_data, original_thumbnail_key, 'image/png'):
+        log(f"  [完了] {folder}: サムネイル生成完了")
         return "success"
     else:
         return "error"
 
 
 def main():
-    global BUCKET_NAME
+    global BUCKET_NAME, cpu_pool
 
     # コマンドライン引数のパース
     parser = argparse.ArgumentParser(
@@ -138,6 +324,15 @@ def main():
 
   python generate_thumbnails.py --bucket bento-pro-generator-production
     → 本番環境のバケットを指定
+
+  python generate_thumbnails.py --concurrency 64
+    → 64フォルダずつ並列に処理
+
+  python generate_thumbnails.py --inventory s3://inventory-bucket/.../manifest.json
+    → S3インベントリから対象を決める（大規模なバケット向け）
+
+  python generate_thumbnails.py --resume thumbnails_manifest.json
+    → 定期実行向け。2回目以降は新しい履歴と前回のエラー分だけを処理
         '''
     )
     parser.add_argument(
@@ -145,6 +340,24 @@ def main():
         type=str,
         help='S3バケット名（指定しない場合は.envの設定を使用）'
     )
+    parser.add_argument(
+        '--inventory',
+        type=str,
+        help='S3インベントリ（CSV形式）の manifest.json（例: s3://inventory-bucket/.../manifest.json）。'
+             '指定するとバケットを一覧せずにインベントリから対象を決める（作成時点以降の変更は反映されない）'
+    )
+    parser.add_argument(
+        '--resume',
+        type=str,
+        metavar='MANIFEST',
+        help='実行結果を記録するJSONファイル。次回以降は前回より新しい履歴と前回エラーになった履歴だけを対象にする'
+    )
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help=f'並列に処理するフォルダ数（デフォルト: {DEFAULT_CONCURRENCY}。S3の接続数は最大{S3_CLIENT_CONFIG.max_pool_connections}）'
+    )
 
     args = parser.parse_args()
 
@@ -157,6 +370,8 @@ def main():
     print("=" * 60)
     print()
     print(f"対象バケット: {BUCKET_NAME}")
+    print(f"並列数: {args.concurrency}")
+    print(f"Pillow: {PIL.__version__}{'（SIMD版）' if PILLOW_SIMD else ''}")
     print()
 
     # 実行確認
@@ -170,9 +385,27 @@ def main():
 
     print()
 
+    # 前回実行時の記録を読み込み
+    resume_state = load_resume_state(args.resume) if args.resume else {}
+    listed_until = resume_state.get("listed_until", "")
+
     # 履歴フォルダ一覧を取得
-    print("S3から履歴フォルダ一覧を取得中...")
-    folders = list_history_folders()
+    if args.inventory:
+        print("S3インベントリから履歴フォルダ一覧を取得中...")
+        folders = list_history_folders_from_inventory(args.inventory)
+    else:
+        print("S3から履歴フォルダ一覧を取得中...")
+        if listed_until:
+            print(f"（前回の記録により {listed_until} より新しい履歴のみ）")
+        # 履歴フォルダ名はタイムスタンプのため、前回一覧した最後のフォルダ以降だけを一覧すればよい
+        # （タイムスタンプ形式でないフォルダは作成順に並ばないため、記録する位置には使わない）
+        folders = list_history_folders(start_after=listed_until)
+        listed_until = max([listed_until] + [folder for folder in folders if HISTORY_FOLDER_PATTERN.fullmatch(folder)])
+
+    # 前回エラーになったフォルダはフォルダ単位で一覧し直して再処理する
+    for folder in resume_state.get("failed", []):
+        if folder not in folders:
+            folders.update(list_history_folders(f"{folder}/"))
 
     if not folders:
         print("履歴フォルダが見つかりませんでした。")
@@ -181,14 +414,58 @@ def main():
     print(f"取得完了: {len(folders)}件の履歴が見つかりました")
     print()
 
-    # 各フォルダを処理
-    stats = {"success": 0, "skip": 0, "error": 0}
+    # サムネイルが既にあるフォルダは一覧の結果だけで判定し、スレッドプールに渡さない
+    pending = {folder: files for folder, files in folders.items() if not has_thumbnail(files)}
+    print(f"サムネイル作成対象: {len(pending)}件（既存のためスキップ: {len(folders) - len(pending)}件）")
+    print()
+
+    # 各フォルダを並列に処理（集計は完了順にメインスレッドで行う）
+    stats = {"success": 0, "skip": len(folders) - len(pending), "missing": 0, "error": 0}
+
+    # 通信（取得・アップロード）とCPU処理（サムネイル生成）を別々のプールで実行し、互いの待ち時間を重ねる
+    concurrency = max(1, args.concurrency)
+    log_writer = threading.Thread(target=_write_logs, daemon=True)
+    log_writer.start()
+    failed = []
+    try:
+        # 通信用スレッドの動作中にforkしないよう、子プロセスは spawn で起動する
+        with ProcessPoolExecutor(max_workers=CPU_WORKERS, mp_context=multiprocessing.get_context('spawn')) as cpu_pool, \
+                ThreadPoolExecutor(max_workers=concurrency) as executor:
+            # 実行中・待機中のタスクを並列数の2倍までに抑え、フォルダ数が多くてもタスクを一度に積み上げない
+            tasks = iter(pending.items())
+            in_flight = {}
+            done_count = 0
+            while True:
+                for folder, files in tasks:
+                    in_flight[executor.submit(generate_thumbnail_for_folder, folder, files)] = folder
+                    if len(in_flight) >= concurrency * 2:
+                        break
+                if not in_flight:
+                    break
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    folder = in_flight.pop(future)
+                    # 壊れた画像や想定外の通信エラーでも全体を止めず、そのフォルダだけエラーとして数える
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        log(f"  サムネイル生成エラー ({folder}): {str(e)}")
+                        result = "error"
+                    stats[result] += 1
+                    if result == "error":
+                        failed.append(folder)
+                    done_count += 1
+                    if done_count % 100 == 0 or done_count == len(pending):
+                        log(f"進捗: {done_count}/{len(pending)}")
+    finally:
+        # 中断された場合も、残りのログを出力し終えてから終了する
+        _log_queue.put(None)
+        log_writer.join()
+    print()
 
-    for idx, folder in enumerate(folders, 1):
-        print(f"[{idx}/{len(folders)}] {folder}")
-        result = generate_thumbnail_for_folder(folder)
-        stats[result] += 1
-        print()
+    # 次回実行のために記録を保存
+    if args.resume:
+        save_resume_state(args.resume, {"listed_until": listed_until, "failed": sorted(failed)})
 
     # 結果サマリー
     print("=" * 60)
@@ -196,6 +473,7 @@ def main():
     print("=" * 60)
     print(f"成功: {stats['success']}件")
     print(f"スキップ（既存）: {stats['skip']}件")
+    print(f"対象外（original.pngなし）: {stats['missing']}件")
     print(f"エラー: {stats['error']}件")
     print()
 